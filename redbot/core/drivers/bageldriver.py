@@ -1,39 +1,48 @@
 import asyncio
 import getpass
-from typing import Any, Dict, Final, Optional, Union, AsyncIterator, Tuple
+from typing import Any, Dict, Final, List, Optional, Union, AsyncIterator, Tuple
 
 import aiohttp
-from aiohttp import ClientTimeout, JsonPayload
+from aiohttp import ClientTimeout
 
 from redbot import json
 from redbot.core import errors
 from redbot.core.drivers.log import log
-from secrets import compare_digest
 
 
 from .base import BaseDriver, IdentifierData, ConfigCategory
 
 __all__ = ["BagelDriver"]
 
+_BATCH_SIZE: Final[int] = 256
+_MAX_CONCURRENT_BATCHES: Final[int] = 16
+_MAX_RETRIES: Final[int] = 5
+_JSON_HEADERS: Final[Dict[str, str]] = {"Content-Type": "application/json"}
 
-_GET_ENDPOINT: Final[str] = "{base}/config/get"
-_AITER_COGS_ENDPOINT: Final[str] = "{base}/config/cogs"
-_SET_ENDPOINT: Final[str] = "{base}/config/set"
-_INCREMENT_ENDPOINT: Final[str] = "{base}/config/increment"
-_TOGGLE_ENDPOINT: Final[str] = "{base}/config/toggle"
-_CLEAR_ENDPOINT: Final[str] = "{base}/config/clear"
-_CLEAR_ALL_ENDPOINT: Final[str] = "{base}/config/clear_all"
+
+def _dump_str(value: Any) -> bytes:
+    # orjson already produces UTF-8 bytes, no need to go through str and back.
+    # Non-str keys are stringified, like the stdlib json module would.
+    if json.json_module == "orjson":
+        return json.mainjson.dumps(value, option=json.mainjson.OPT_NON_STR_KEYS)
+    # ujson and json escape non-ASCII characters by default, so this encode is ASCII only
+    return json.mainjson.dumps(value).encode("utf-8")
 
 
 # noinspection PyProtectedMember
 class BagelDriver(BaseDriver):
-    __token: Optional[str] = None
-    __base_url: Optional[str] = None
     __sockets: Optional[str] = None
     __timeout: Optional[ClientTimeout] = None
-    __connector: Optional[aiohttp.UnixConnector] = None
-    __connector_owner: bool = False
+    __session: Optional[aiohttp.ClientSession] = None
     __default_headers: Dict[str, Any] = {}
+    __get_url: Optional[str] = None
+    __aiter_cogs_url: Optional[str] = None
+    __set_url: Optional[str] = None
+    __increment_url: Optional[str] = None
+    __toggle_url: Optional[str] = None
+    __clear_url: Optional[str] = None
+    __clear_all_url: Optional[str] = None
+    __batch_url: Optional[str] = None
     __serializer: str = json.json_module
 
     @property
@@ -46,22 +55,35 @@ class BagelDriver(BaseDriver):
         password = storage_details["password"]
         sockets = storage_details["unix_socket"]
         timeout = storage_details.get("timeout", 5)
-        cls.__token = password
-        cls.__base_url = host
+        cls.__get_url = f"{host}/config/get"
+        cls.__aiter_cogs_url = f"{host}/config/cogs"
+        cls.__set_url = f"{host}/config/set"
+        cls.__increment_url = f"{host}/config/increment"
+        cls.__toggle_url = f"{host}/config/toggle"
+        cls.__clear_url = f"{host}/config/clear"
+        cls.__clear_all_url = f"{host}/config/clear_all"
+        cls.__batch_url = f"{host}/config/batch"
         cls.__sockets = sockets
         cls.__timeout = ClientTimeout(total=timeout)
-        cls.__connector = (
-            aiohttp.UnixConnector(path=cls.__sockets, keepalive_timeout=15.0, limit=0)
-            if cls.__sockets
-            else None
+        cls.__default_headers = {"Authorization": password} if password else {}
+        if cls.__sockets:
+            connector = aiohttp.UnixConnector(path=cls.__sockets, keepalive_timeout=15.0, limit=0)
+        else:
+            # All requests go to the same host, so keep plenty of connections alive for reuse
+            connector = aiohttp.TCPConnector(
+                limit=64, limit_per_host=64, ttl_dns_cache=300, keepalive_timeout=60.0
+            )
+        cls.__session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=cls.__timeout,
+            headers=cls.__default_headers,
         )
-        cls.__connector_owner = False if cls.__connector else True
-        cls.__default_headers = {"Authorization": cls.__token}
 
     @classmethod
     async def teardown(cls) -> None:
-        if cls.__connector is not None:
-            await cls.__connector.close()
+        if cls.__session is not None:
+            await cls.__session.close()
+            cls.__session = None
 
     @staticmethod
     def get_config_details():
@@ -73,9 +95,7 @@ class BagelDriver(BaseDriver):
                 f"> "
             )
             or "http://localhost:8005"
-        )
-        if host.endswith("/"):
-            host = host[:-1]
+        ).rstrip("/")
         password = getpass.getpass(
             f"Enter the API server password. The input will be hidden.\n"
             f"  NOTE: If the server requires no password, enter NONE (Case sensitive).\n"
@@ -83,7 +103,7 @@ class BagelDriver(BaseDriver):
             f" - No password.\n"
             f"> "
         )
-        if compare_digest(password, "NONE"):
+        if password == "NONE":
             password = None
         sockets = (
             input(
@@ -112,71 +132,74 @@ class BagelDriver(BaseDriver):
     async def get(self, identifier_data: IdentifierData):
         full_identifiers = identifier_data.to_dict()
         try:
-            async with aiohttp.ClientSession(
-                json_serialize=json.dumps,
-                connector=self.__connector,
-                timeout=self.__timeout,
-                connector_owner=self.__connector_owner,
-                headers=self.__default_headers,
-            ) as session:
-                async with session.post(
-                    url=_GET_ENDPOINT.replace("{base}", self.__base_url),
-                    data=JsonPayload({"identifier": full_identifiers}, dumps=json.dumps),
-                ) as response:
-                    if response.status == 200:
-                        return await response.json(loads=json.loads)
-                    else:
-                        raise KeyError
+            async with self.__session.post(
+                url=self.__get_url,
+                data=_dump_str({"identifier": full_identifiers}),
+                headers=_JSON_HEADERS,
+            ) as response:
+                if response.status == 200:
+                    return json.loads(await response.read())
+                else:
+                    raise KeyError
         except (asyncio.TimeoutError, aiohttp.ClientConnectorError):
             return await self.get(identifier_data=identifier_data)
 
     async def set(self, identifier_data: IdentifierData, value=None):
         full_identifiers = identifier_data.to_dict()
         try:
-            async with aiohttp.ClientSession(
-                json_serialize=json.dumps,
-                connector=self.__connector,
-                timeout=self.__timeout,
-                connector_owner=self.__connector_owner,
-                headers=self.__default_headers,
-            ) as session:
-                async with session.put(
-                    url=_SET_ENDPOINT.replace("{base}", self.__base_url),
-                    data=JsonPayload(
-                        {
-                            "identifier": full_identifiers,
-                            "config_data": json.dumps(value),
-                        },
-                        dumps=json.dumps,
-                    ),
-                ) as response:
-                    response_output = await response.json(loads=json.loads)
-                    if response.status == 200:
-                        return response_output.get("value")
-                    else:
-                        raise errors.ConfigError(str(response_output))
+            async with self.__session.put(
+                url=self.__set_url,
+                data=_dump_str(
+                    {
+                        "identifier": full_identifiers,
+                        "config_data": value,
+                    }
+                ),
+                headers=_JSON_HEADERS,
+            ) as response:
+                response_output = json.loads(await response.read())
+                if response.status == 200:
+                    return response_output.get("value")
+                else:
+                    raise errors.ConfigError(str(response_output))
         except (asyncio.TimeoutError, aiohttp.ClientConnectorError):
             return await self.set(identifier_data=identifier_data, value=value)
 
+    async def set_many(
+        self, identifier_data: IdentifierData, items: List[Tuple[Tuple[str, ...], Any]]
+    ) -> None:
+        """Set the values for multiple primary keys of a category in a single request.
+
+        The identifier is only sent once and each item only carries its primary key.
+        Failed requests aren't retried, callers are expected to fall back to `set`.
+        """
+        async with self.__session.put(
+            url=self.__batch_url,
+            data=_dump_str(
+                {
+                    "base": identifier_data.to_dict(),
+                    "items": [{"pkey": pkey, "value": value} for pkey, value in items],
+                }
+            ),
+            headers=_JSON_HEADERS,
+        ) as response:
+            response_output = json.loads(await response.read())
+            if response.status != 200:
+                raise errors.ConfigError(str(response_output))
+
     async def clear(self, identifier_data: IdentifierData):
         full_identifiers = identifier_data.to_dict()
         try:
-            async with aiohttp.ClientSession(
-                json_serialize=json.dumps,
-                connector=self.__connector,
-                timeout=self.__timeout,
-                connector_owner=self.__connector_owner,
-                headers=self.__default_headers,
-            ) as session:
-                async with session.put(
-                    url=_CLEAR_ENDPOINT.replace("{base}", self.__base_url),
-                    data=JsonPayload({"identifier": full_identifiers}, dumps=json.dumps),
-                ) as response:
-                    response_output = await response.json(loads=json.loads)
-                    if response.status == 200:
-                        return response_output.get("value")
-                    else:
-                        raise errors.ConfigError(str(response_output))
+            async with self.__session.put(
+                url=self.__clear_url,
+                data=_dump_str({"identifier": full_identifiers}),
+                headers=_JSON_HEADERS,
+            ) as response:
+                response_output = json.loads(await response.read())
+                if response.status == 200:
+                    return response_output.get("value")
+                else:
+                    raise errors.ConfigError(str(response_output))
         except (asyncio.TimeoutError, aiohttp.ClientConnectorError):
             return await self.clear(identifier_data=identifier_data)
 
@@ -188,29 +211,22 @@ class BagelDriver(BaseDriver):
     ) -> Union[int, float]:
         try:
             full_identifiers = identifier_data.to_dict()
-            async with aiohttp.ClientSession(
-                json_serialize=json.dumps,
-                connector=self.__connector,
-                timeout=self.__timeout,
-                connector_owner=self.__connector_owner,
-                headers=self.__default_headers,
-            ) as session:
-                async with session.put(
-                    url=_INCREMENT_ENDPOINT.replace("{base}", self.__base_url),
-                    data=JsonPayload(
-                        {
-                            "identifier": full_identifiers,
-                            "config_data": json.dumps(value),
-                            "default": json.dumps(default),
-                        },
-                        dumps=json.dumps,
-                    ),
-                ) as response:
-                    response_output = await response.json(loads=json.loads)
-                    if response.status == 200:
-                        return response_output.get("value")
-                    else:
-                        raise errors.ConfigError(str(response_output))
+            async with self.__session.put(
+                url=self.__increment_url,
+                data=_dump_str(
+                    {
+                        "identifier": full_identifiers,
+                        "config_data": value,
+                        "default": default,
+                    }
+                ),
+                headers=_JSON_HEADERS,
+            ) as response:
+                response_output = json.loads(await response.read())
+                if response.status == 200:
+                    return response_output.get("value")
+                else:
+                    raise errors.ConfigError(str(response_output))
         except (asyncio.TimeoutError, aiohttp.ClientConnectorError):
             return await self.inc(identifier_data=identifier_data, value=value, default=default)
 
@@ -219,29 +235,22 @@ class BagelDriver(BaseDriver):
     ) -> bool:
         try:
             full_identifiers = identifier_data.to_dict()
-            async with aiohttp.ClientSession(
-                json_serialize=json.dumps,
-                connector=self.__connector,
-                timeout=self.__timeout,
-                connector_owner=self.__connector_owner,
-                headers=self.__default_headers,
-            ) as session:
-                async with session.put(
-                    url=_TOGGLE_ENDPOINT.replace("{base}", self.__base_url),
-                    data=JsonPayload(
-                        {
-                            "identifier": full_identifiers,
-                            "config_data": json.dumps(value),
-                            "default": json.dumps(default),
-                        },
-                        dumps=json.dumps,
-                    ),
-                ) as response:
-                    response_output = await response.json(loads=json.loads)
-                    if response.status == 200:
-                        return response_output.get("value")
-                    else:
-                        raise errors.ConfigError(str(response_output))
+            async with self.__session.put(
+                url=self.__toggle_url,
+                data=_dump_str(
+                    {
+                        "identifier": full_identifiers,
+                        "config_data": value,
+                        "default": default,
+                    }
+                ),
+                headers=_JSON_HEADERS,
+            ) as response:
+                response_output = json.loads(await response.read())
+                if response.status == 200:
+                    return response_output.get("value")
+                else:
+                    raise errors.ConfigError(str(response_output))
         except (asyncio.TimeoutError, aiohttp.ClientConnectorError):
             return await self.toggle(identifier_data=identifier_data, value=value, default=default)
 
@@ -249,41 +258,65 @@ class BagelDriver(BaseDriver):
     async def delete_all_data(cls, **kwargs) -> None:
         """Delete all data being stored by this driver."""
         try:
-            async with aiohttp.ClientSession(
-                json_serialize=json.dumps,
-                connector=cls.__connector,
-                timeout=cls.__timeout,
-                connector_owner=cls.__connector_owner,
-                headers=cls.__default_headers,
-            ) as session:
-                async with session.put(
-                    url=_CLEAR_ALL_ENDPOINT.replace("{base}", cls.__base_url),
-                    param={"i_want_to_do_this": True},
-                ) as response:
-                    response_output = await response.json(loads=json.loads)
-                    if response.status == 200:
-                        return response_output.get("value")
-                    else:
-                        raise errors.ConfigError(str(response_output))
+            async with cls.__session.put(
+                url=cls.__clear_all_url,
+                param={"i_want_to_do_this": True},
+            ) as response:
+                response_output = json.loads(await response.read())
+                if response.status == 200:
+                    return response_output.get("value")
+                else:
+                    raise errors.ConfigError(str(response_output))
         except (asyncio.TimeoutError, aiohttp.ClientConnectorError):
             return await cls.delete_all_data(**kwargs)
 
     @classmethod
     async def aiter_cogs(cls) -> AsyncIterator[Tuple[str, str]]:
-        try:
-            async with aiohttp.ClientSession(
-                json_serialize=json.dumps,
-                connector=cls.__connector,
-                timeout=cls.__timeout,
-                connector_owner=cls.__connector_owner,
-                headers=cls.__default_headers,
-            ) as session:
-                async with session.post(
-                    url=_AITER_COGS_ENDPOINT.replace("{base}", cls.__base_url),
+        attempt = 0
+        yielded = False
+        while True:
+            try:
+                # The consumer may take a while between cogs, so instead of a total timeout,
+                # each read (including the one for the response headers) is bound by it.
+                # aiohttp doesn't count time spent with reading paused by the consumer.
+                async with cls.__session.post(
+                    url=cls.__aiter_cogs_url,
+                    timeout=ClientTimeout(
+                        sock_connect=cls.__timeout.total, sock_read=cls.__timeout.total
+                    ),
                 ) as response:
-                    return await response.json(loads=json.loads)
-        except (asyncio.TimeoutError, aiohttp.ClientConnectorError):
-            return await cls.aiter_cogs()
+                    if response.status != 200:
+                        raise errors.ConfigError(await response.text())
+                    if response.content_type != "application/x-ndjson":
+                        raise errors.ConfigError(
+                            f"Expected an application/x-ndjson response from {response.url}, "
+                            f"got {response.content_type}"
+                        )
+                    # Newline delimited JSON, one [cog_name, cog_id] pair per line
+                    async for line in response.content:
+                        if not line.strip():
+                            continue
+                        cog = json.loads(line)
+                        if not isinstance(cog, list) or len(cog) != 2:
+                            raise errors.ConfigError(f"Invalid cog entry: {line!r}")
+                        yielded = True
+                        yield tuple(cog)
+                return
+            except (asyncio.TimeoutError, aiohttp.ClientConnectorError) as err:
+                # Retrying after something was yielded would yield those cogs again
+                if yielded:
+                    raise
+                attempt += 1
+                if attempt >= _MAX_RETRIES:
+                    raise errors.ConfigError(
+                        f"Could not retrieve the cog list after {attempt} attempts"
+                    ) from err
+                log.warning(
+                    f"Retrieving the cog list failed (attempt {attempt} of {_MAX_RETRIES}), "
+                    f"retrying",
+                    exc_info=err,
+                )
+                await asyncio.sleep(0.5 * 2 ** (attempt - 1))
 
     async def import_data(self, cog_data, custom_group_data):
         log.info(f"Converting Cog: {self.cog_name}")
@@ -304,16 +337,50 @@ class BagelDriver(BaseDriver):
 
     async def _individual_migrate(self, category, custom_group_data, all_data):
         splitted_pkey = self._split_primary_key(category, custom_group_data, all_data)
-        for pkey, data in splitted_pkey:
-            ident_data = IdentifierData(
-                self.cog_name,
-                self.unique_cog_identifier,
-                category,
-                pkey,
-                (),
-                *ConfigCategory.get_pkey_info(category, custom_group_data),
+        pkey_info = ConfigCategory.get_pkey_info(category, custom_group_data)
+        base_ident_data = IdentifierData(
+            self.cog_name, self.unique_cog_identifier, category, (), (), *pkey_info
+        )
+        semaphore = asyncio.Semaphore(_MAX_CONCURRENT_BATCHES)
+        use_batches = True
+
+        async def migrate_batch(batch):
+            nonlocal use_batches
+            async with semaphore:
+                if use_batches:
+                    try:
+                        await self.set_many(base_ident_data, batch)
+                    except Exception as err:
+                        # The server may not support batches at all,
+                        # don't pay for a failing request on every remaining batch.
+                        use_batches = False
+                        log.warning(
+                            f"Batch save failed for {base_ident_data.__repr__()}, "
+                            f"saving the remaining entries one by one",
+                            exc_info=err,
+                        )
+                    else:
+                        return
+                # Save one by one so that only the entries which can't be saved get lost
+                for pkey, data in batch:
+                    ident_data = IdentifierData(
+                        self.cog_name,
+                        self.unique_cog_identifier,
+                        category,
+                        pkey,
+                        (),
+                        *pkey_info,
+                    )
+                    try:
+                        await self.set(ident_data, data)
+                    except Exception as err:
+                        log.critical(
+                            f"Error saving: {ident_data.__repr__()}: {data}", exc_info=err
+                        )
+
+        await asyncio.gather(
+            *(
+                migrate_batch(splitted_pkey[start : start + _BATCH_SIZE])
+                for start in range(0, len(splitted_pkey), _BATCH_SIZE)
             )
-            try:
-                await self.set(ident_data, data)
-            except Exception as err:
-                log.critical(f"Error saving: {ident_data.__repr__()}: {data}", exc_info=err)
+        )
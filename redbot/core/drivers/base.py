@@ -398,19 +398,18 @@ class BaseDriver(abc.ABC):
         if pkey_len == 0:
             return [((), data)]
 
+        ret = []
+
+        # Append straight into the result instead of building a dict at every level
         def flatten(levels_remaining, currdata, parent_key=()):
-            items = []
             for _k, _v in currdata.items():
                 new_key = parent_key + (_k,)
                 if levels_remaining > 1:
-                    items.extend(flatten(levels_remaining - 1, _v, new_key).items())
+                    flatten(levels_remaining - 1, _v, new_key)
                 else:
-                    items.append((new_key, _v))
-            return dict(items)
+                    ret.append((new_key, _v))
 
-        ret = []
-        for k, v in flatten(pkey_len, data).items():
-            ret.append((k, v))
+        flatten(pkey_len, data)
         return ret
 
     async def export_data(
@@ -0,0 +1,109 @@
+import asyncio
+from unittest.mock import AsyncMock
+
+import pytest
+
+from redbot.core.drivers import BagelDriver, BaseDriver
+from redbot.core.drivers.log import log
+from redbot.core.errors import ConfigError
+
+
+def test_split_primary_key_no_pkey():
+    data = {"enabled": True, "nested": {}}
+    assert BaseDriver._split_primary_key("GLOBAL", {}, data) == [((), data)]
+
+
+def test_split_primary_key_single_level():
+    data = {"2": {"prefix": "!"}, "1": {}, "3": {"enabled": False}}
+    assert BaseDriver._split_primary_key("GUILD", {}, data) == [
+        (("2",), {"prefix": "!"}),
+        (("1",), {}),
+        (("3",), {"enabled": False}),
+    ]
+
+
+def test_split_primary_key_two_levels():
+    data = {
+        "20": {"5": {"xp": 1}, "4": {}},
+        "10": {},
+        "30": {"6": {"xp": 3}},
+    }
+    assert BaseDriver._split_primary_key("MEMBER", {}, data) == [
+        (("20", "5"), {"xp": 1}),
+        (("20", "4"), {}),
+        (("30", "6"), {"xp": 3}),
+    ]
+
+
+def test_split_primary_key_custom_group():
+    data = {"a": {"b": {"value": 1}}, "c": {"d": {}}}
+    assert BaseDriver._split_primary_key("CustomGroup", {"CustomGroup": 2}, data) == [
+        (("a", "b"), {"value": 1}),
+        (("c", "d"), {}),
+    ]
+
+
+@pytest.fixture()
+def bagel_session(mocker):
+    session = mocker.MagicMock()
+    mocker.patch.object(BagelDriver, "_BagelDriver__session", session)
+    return session
+
+
+def _failing_batch_response(session):
+    response = session.put.return_value.__aenter__.return_value
+    response.status = 500
+    response.read = AsyncMock(return_value=b'{"detail": "Internal Server Error"}')
+
+
+def _timing_out_batch_response(session):
+    session.put.return_value.__aenter__.side_effect = asyncio.TimeoutError
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("make_batch_fail", [_failing_batch_response, _timing_out_batch_response])
+async def test_bagel_failed_batch_falls_back_to_set(mocker, bagel_session, make_batch_fail):
+    make_batch_fail(bagel_session)
+    driver = BagelDriver("Cog", "0")
+
+    async def fake_set(identifier_data, value=None):
+        if identifier_data.primary_key == ("2",):
+            raise ConfigError("cannot save")
+
+    mocked_set = mocker.patch.object(driver, "set", side_effect=fake_set)
+    warning = mocker.patch.object(log, "warning")
+    critical = mocker.patch.object(log, "critical")
+
+    data = {"1": {"a": 1}, "2": {"b": 2}, "3": {"c": 3}}
+    await driver._individual_migrate("GUILD", {}, data)
+
+    # The batch is only sent once, then every entry is saved on its own
+    assert bagel_session.put.call_count == 1
+    assert [call.args[0].primary_key for call in mocked_set.await_args_list] == [
+        ("1",),
+        ("2",),
+        ("3",),
+    ]
+    # The batch failure is reported once, with its cause
+    assert warning.call_count == 1
+    assert warning.call_args.kwargs["exc_info"] is not None
+    # Only the entry which couldn't be saved is logged
+    assert critical.call_count == 1
+    assert "primary_key=('2',)" in critical.call_args.args[0]
+
+
+@pytest.mark.asyncio
+async def test_bagel_failed_batch_disables_remaining_batches(mocker, bagel_session):
+    _failing_batch_response(bagel_session)
+    mocker.patch("redbot.core.drivers.bageldriver._BATCH_SIZE", 2)
+    driver = BagelDriver("Cog", "0")
+    mocked_set = mocker.patch.object(driver, "set")
+    warning = mocker.patch.object(log, "warning")
+
+    data = {str(i): {"value": i} for i in range(6)}
+    await driver._individual_migrate("GUILD", {}, data)
+
+    # Only the first of the three batches is attempted
+    assert bagel_session.put.call_count == 1
+    assert warning.call_count == 1
+    assert mocked_set.await_count == 6